@@ -2,18 +2,49 @@ import os
 import re
 import json
 import sys
+import asyncio
+import tempfile
 import logging
-import requests
-from bs4 import BeautifulSoup
+import functools
+import aiohttp
+import aiofiles
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from markdownify import markdownify as md
 from datetime import datetime
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit, urlunsplit
 from lxml import etree  # 用于XPath解析
+import lxml.html
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 文件名清理用的预编译正则
+_NON_WORD_RE = re.compile(r'[^\w\-]')
+_DASHES_RE = re.compile(r'-+')
+
+# 提取可见文本，排除<script>/<style>/<template>中的内容（与BeautifulSoup的get_text一致）
+_VISIBLE_TEXT_XPATH = etree.XPath('.//text()[not(ancestor::script or ancestor::style or ancestor::template)]')
+
+# 本次运行中的图片下载任务（按本地保存路径索引的LRU缓存），同一图片只下载一次
+_IMAGE_TASKS_MAXSIZE = 4096
+_image_tasks = OrderedDict()
+
+# 不超过此大小（已知Content-Length）的图片先完整读取，再一次写入
+_SMALL_IMAGE_SIZE = 1024 * 1024
+# 分块写入时每块的最大字节数：大小未知时64KB，已知超过1MB时1MB
+_UNKNOWN_SIZE_CHUNK = 64 * 1024
+_LARGE_IMAGE_CHUNK = 1024 * 1024
+
+# 新建文件的权限，与open()创建文件时一致（0666去掉umask）
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+_FILE_MODE = 0o666 & ~_UMASK
+
+# front-matter双引号字符串的转义表
+_ESCAPE_TABLE = str.maketrans({'"': '\\"', '\\': '\\\\', '\n': '\\n'})
+
 def load_config(config_path):
     """加载指定路径的JSON配置文件"""
     try:
@@ -36,6 +67,22 @@ def load_config(config_path):
                 logger.error(f"配置文件中缺少必要字段: {field}")
                 raise ValueError(f"Missing required field configuration: {field}")
         
+        # 检查并发数配置（可选，必须为正整数）
+        max_workers = config.get('max_workers', 16)
+        if isinstance(max_workers, bool) or not isinstance(max_workers, int) or max_workers < 1:
+            logger.error(f"配置项 max_workers 必须为正整数: {max_workers}")
+            raise ValueError("Invalid max_workers configuration: must be a positive integer")
+        
+        # 预先编译各字段的XPath表达式，提取时直接复用
+        for field_name, field_config in config['fields'].items():
+            if 'xpath' not in field_config:
+                continue
+            try:
+                field_config['_compiled_xpath'] = etree.XPath(field_config['xpath'])
+            except etree.XPathSyntaxError:
+                logger.error(f"字段 {field_name} 的XPath表达式无效: {field_config['xpath']}")
+                raise ValueError(f"Invalid xpath for field: {field_name}")
+        
         return config
     except FileNotFoundError:
         logger.error(f"配置文件 {config_path} 不存在")
@@ -76,58 +123,75 @@ def get_downloaded_urls(project_root):
         logger.error(f"读取已下载URL记录时出错: {str(e)}")
         return set()
 
-def mark_as_downloaded(project_root, url):
-    """将URL标记为已下载"""
-    downloaded_log_path = os.path.join(project_root, 'downloaded.log')
+def mark_as_downloaded(downloaded_log, url):
+    """将URL标记为已下载（写入已打开的downloaded.log文件）"""
     try:
-        with open(downloaded_log_path, 'a', encoding='utf-8') as f:
-            f.write(f"{url}\n")
+        downloaded_log.write(f"{url}\n")
+        # 每条记录立即刷新，程序中断时已完成的URL不会丢失
+        downloaded_log.flush()
         logger.info(f"已标记URL为已下载: {url}")
     except Exception as e:
         logger.error(f"标记URL为已下载时出错: {str(e)}")
 
-def fetch_page_content(url):
-    """获取网页内容"""
+async def fetch_page_content(session, url):
+    """获取网页内容（原始字节），同时返回响应头中声明的编码"""
     try:
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()  # 抛出HTTP错误
-        return response.text, url
-    except requests.exceptions.RequestException as e:
+        async with session.get(url, headers=headers) as response:
+            response.raise_for_status()  # 抛出HTTP错误
+            # 直接返回字节，交给lxml解析，避免额外解码为str
+            # 响应头未声明charset时为None，由lxml根据<meta charset>自动识别
+            return await response.read(), url, response.charset
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logger.error(f"获取网页内容失败 {url}: {str(e)}")
-        return None, url
+        return None, url, None
+
+def join_url(base_parts, url):
+    """基于预先解析的base URL拼接相对路径，常见情况下无需重复解析base URL"""
+    if url.startswith(('http://', 'https://')):
+        return url
+    # 包含 ./ 或 ../ 的路径需要规范化，交给urljoin处理
+    if '/.' not in url:
+        if url.startswith('//'):
+            return f"{base_parts.scheme}:{url}"
+        if url.startswith('/'):
+            return f"{base_parts.scheme}://{base_parts.netloc}{url}"
+    return urljoin(urlunsplit(base_parts), url)
 
-def extract_field(html_content, xpath, attribute, base_url):
-    """使用XPath提取字段内容"""
+@functools.lru_cache(maxsize=None)
+def get_html_parser(encoding=None):
+    """获取指定编码的共享HTML解析器，避免每个页面重复创建解析器"""
+    # 解析只在事件循环所在线程中进行，共享解析器是安全的
+    return etree.HTMLParser(recover=True, encoding=encoding)
+
+def extract_field(tree, field_config, base_parts):
+    """使用字段配置中预编译的XPath从已解析的文档树中提取字段内容"""
+    xpath = field_config['xpath']
+    attribute = field_config['attribute']
     try:
-        # 使用XPath解析
-        tree = etree.HTML(html_content)
-        elements = tree.xpath(xpath)
+        elements = field_config['_compiled_xpath'](tree)
         if not elements:
             logger.warning(f"XPath未找到匹配的元素: {xpath}")
             return None
         
         # 处理XPath结果
         element = elements[0]
-        if isinstance(element, etree._Element):
-            element_html = etree.tostring(element, encoding='unicode')
-            element_soup = BeautifulSoup(element_html, 'html.parser')
-        else:
+        if not isinstance(element, etree._Element):
             # 如果是文本节点
             return str(element).strip()
         
-        # 提取属性
+        # 直接在lxml元素上提取属性，避免序列化后再次解析
         if attribute == 'text':
-            return element_soup.get_text(strip=True)
+            return ''.join(text.strip() for text in _VISIBLE_TEXT_XPATH(element))
         elif attribute == 'html':
-            return str(element_soup)
+            return etree.tostring(element, encoding='unicode', method='html', with_tail=False)
         else:
-            value = element_soup.get(attribute, None)
+            value = element.get(attribute)
             # 如果是URL且是相对路径，转换为绝对路径
             if value and attribute in ['src', 'href'] and (value.startswith('/') or not value.startswith('http')):
-                return urljoin(base_url, value)
+                return join_url(base_parts, value)
             return value
             
     except Exception as e:
@@ -140,34 +204,35 @@ def sanitize_filename(name):
     sanitized = name.replace(' ', '-')
     
     # 移除所有标点符号和特殊字符（保留字母、数字和横线）
-    sanitized = re.sub(r'[^\w\-]', '', sanitized)
+    sanitized = _NON_WORD_RE.sub('', sanitized)
     
     # 合并多个连续横线为一个
-    sanitized = re.sub(r'-+', '-', sanitized)
+    sanitized = _DASHES_RE.sub('-', sanitized)
     
     # 转换为小写并截断过长的文件名（最多100个字符）
     # 同时移除可能的开头和结尾横线
     return sanitized.lower().strip('-')[:100]
 
-def download_image(image_url, save_dir, base_url):
-    """下载图片并保存到指定目录"""
-    if not image_url:
-        return None
+def resolve_image(image_url, save_dir, base_parts):
+    """将图片地址解析为绝对URL和本地保存路径"""
+    # 处理相对URL
+    if not image_url.startswith('http'):
+        image_url = join_url(base_parts, image_url)
     
+    # 获取图片文件名
+    image_name = os.path.basename(image_url.split('?')[0])  # 移除URL参数
+    if not image_name or '.' not in image_name:
+        image_name = f"image_{datetime.now().strftime('%Y%m%d%H%M%S')}.jpg"
+    
+    return image_url, os.path.join(save_dir, image_name)
+
+async def download_image(session, image_url, save_path):
+    """下载图片并保存到指定路径，返回图片文件名"""
+    image_name = os.path.basename(save_path)
+    tmp_path = None
     try:
         # 确保保存目录存在
-        os.makedirs(save_dir, exist_ok=True)
-        
-        # 处理相对URL
-        if not image_url.startswith('http'):
-            image_url = urljoin(base_url, image_url)
-        
-        # 获取图片文件名
-        image_name = os.path.basename(image_url.split('?')[0])  # 移除URL参数
-        if not image_name or '.' not in image_name:
-            image_name = f"image_{datetime.now().strftime('%Y%m%d%H%M%S')}.jpg"
-        
-        save_path = os.path.join(save_dir, image_name)
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
         
         # 检查图片是否已存在
         if os.path.exists(save_path):
@@ -178,71 +243,159 @@ def download_image(image_url, save_dir, base_url):
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
-        response = requests.get(image_url, headers=headers, timeout=10, stream=True)
-        response.raise_for_status()
-        
-        with open(save_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        async with session.get(image_url, headers=headers) as response:
+            response.raise_for_status()
+            
+            # 先写入同目录下的临时文件，下载完成后再用os.replace原子替换
+            # 避免下载中途失败时留下不完整的图片，被后续页面和下次运行当作已存在
+            content_length = response.content_length
+            if content_length is not None and content_length <= _SMALL_IMAGE_SIZE:
+                # 已知大小的小图片先读完整个响应体，成功后再创建文件并一次写入
+                body = await response.read()
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(save_path), suffix='.tmp')
+                async with aiofiles.open(fd, 'wb') as f:
+                    await f.write(body)
+            else:
+                # 大图片或未知大小时分块写入；iter_chunked按数据到达情况返回，每块不超过指定大小
+                chunk_size = _UNKNOWN_SIZE_CHUNK if content_length is None else _LARGE_IMAGE_CHUNK
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(save_path), suffix='.tmp')
+                async with aiofiles.open(fd, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        await f.write(chunk)
         
+        # mkstemp创建的文件权限为0600，改为按umask计算的常规权限
+        os.chmod(tmp_path, _FILE_MODE)
+        os.replace(tmp_path, save_path)
+        tmp_path = None
         logger.info(f"图片下载成功: {image_name}")
         return image_name
     except Exception as e:
         logger.error(f"图片下载失败 {image_url}: {str(e)}")
         return None
+    finally:
+        # 下载失败或任务被取消时清理临时文件
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def forget_failed_image(save_path, task):
+    """下载失败的任务不保留在缓存中，后续页面可以重新下载"""
+    if (task.cancelled() or task.result() is None) and _image_tasks.get(save_path) is task:
+        del _image_tasks[save_path]
 
-def download_content_images(content_html, save_dir, base_url):
+def get_image_task(session, image_url, save_path):
+    """获取图片下载任务，同一保存路径在本次运行中只下载一次"""
+    task = _image_tasks.get(save_path)
+    if task is not None:
+        _image_tasks.move_to_end(save_path)
+        return task
+    
+    task = asyncio.ensure_future(download_image(session, image_url, save_path))
+    task.add_done_callback(functools.partial(forget_failed_image, save_path))
+    _image_tasks[save_path] = task
+    # 超出缓存上限时淘汰最久未使用的任务
+    if len(_image_tasks) > _IMAGE_TASKS_MAXSIZE:
+        _image_tasks.popitem(last=False)
+    return task
+
+async def download_content_images(session, content_html, save_dir, base_parts):
     """下载内容中的所有图片并替换为本地路径"""
     if not content_html:
         return content_html
     
-    soup = BeautifulSoup(content_html, 'html.parser')
-    images = soup.find_all('img')
+    # 以片段方式解析，外层包一个<div>，避免生成<html><body>结构
+    fragment = lxml.html.fragment_fromstring(content_html, create_parent='div')
+    
+    # 先收集所有图片，再并发下载
+    images = [(img, img.get('src')) for img in fragment.iter('img') if img.get('src')]
+    if not images:
+        return content_html
+    
+    # 按本地保存路径去重：写法不同但指向同一图片的地址、以及同名图片只下载一次
+    save_paths = {}
+    tasks = {}
+    for img_url in dict.fromkeys(img_url for _, img_url in images):
+        try:
+            absolute_url, save_path = resolve_image(img_url, save_dir, base_parts)
+        except ValueError as e:
+            logger.error(f"图片地址无效 {img_url}: {str(e)}")
+            continue
+        save_paths[img_url] = save_path
+        if save_path not in tasks:
+            tasks[save_path] = get_image_task(session, absolute_url, save_path)
+    img_names = dict(zip(tasks, await asyncio.gather(*tasks.values())))
     
-    for img in images:
-        img_url = img.get('src')
-        if img_url:
-            img_name = download_image(img_url, save_dir, base_url)
-            if img_name:
-                # 修改图片路径，使其指向/static/images/目录
-                img['src'] = f"/static/images/{img_name}"
+    for img, img_url in images:
+        img_name = img_names.get(save_paths.get(img_url))
+        if img_name:
+            # 修改图片路径，使其指向/static/images/目录
+            img.set('src', f"/static/images/{img_name}")
     
-    return str(soup)
+    # 序列化后去掉外层的<div>和</div>
+    return lxml.html.tostring(fragment, encoding='unicode')[5:-6]
 
 def create_markdown_file(save_path, front_matter, content):
     """创建Markdown文件"""
     # 确保保存目录存在
     os.makedirs(os.path.dirname(save_path), exist_ok=True)
     
-    # 构建Markdown内容
-    md_content = "---\n"
+    # 构建Markdown内容（先收集各部分再一次性拼接）
+    parts = ["---\n"]
     # 添加front-matter字段
     for key, value in front_matter.items():
         if value is not None:
-            # 处理包含双引号的值
-            escaped_value = str(value).replace('"', '\\"')
-            md_content += f"{key}: \"{escaped_value}\"\n"
-    md_content += "---\n\n"
-    md_content += content
+            # 转义双引号、反斜杠和换行，一次扫描完成
+            escaped_value = str(value).translate(_ESCAPE_TABLE)
+            parts.append(f"{key}: \"{escaped_value}\"\n")
+    parts.append("---\n\n")
+    parts.append(content)
+    md_content = ''.join(parts)
     
+    # 先写入同目录下的临时文件，再用os.replace原子替换，避免留下写了一半的文件
+    tmp_path = None
     try:
-        with open(save_path, 'w', encoding='utf-8') as f:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(save_path), suffix='.tmp')
+        with open(fd, 'w', encoding='utf-8') as f:
             f.write(md_content)
+        # mkstemp创建的文件权限为0600，改为按umask计算的常规权限
+        os.chmod(tmp_path, _FILE_MODE)
+        os.replace(tmp_path, save_path)
         logger.info(f"Markdown文件创建成功: {save_path}")
         return True
     except Exception as e:
         logger.error(f"创建Markdown文件失败: {str(e)}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
         return False
 
-def process_url(url, config):
-    """处理单个URL的采集流程"""
+def save_markdown(save_path, front_matter, content_html):
+    """将HTML内容转换为Markdown并创建文件（可在子进程中执行）"""
+    content_md = md(content_html)
+    return create_markdown_file(save_path, front_matter, content_md)
+
+async def process_url(session, url, config, markdown_executor=None):
+    """处理单个URL的采集流程，提供进程池时Markdown转换在子进程中执行"""
     logger.info(f"开始处理URL: {url}")
     
     # 获取网页内容
-    html_content, base_url = fetch_page_content(url)
+    html_content, base_url, encoding = await fetch_page_content(session, url)
     if not html_content:
         return False
     
+    # 预先解析base URL，供字段提取和图片下载时拼接相对路径
+    base_parts = urlsplit(base_url)
+    
+    # 只解析一次网页，所有字段共用同一棵文档树
+    try:
+        parser = get_html_parser(encoding)
+    except LookupError:
+        # 响应头声明了无法识别的编码（如utf8mb4），改由lxml根据<meta charset>识别
+        logger.warning(f"无法识别的网页编码 {encoding}，改为自动识别: {url}")
+        parser = get_html_parser(None)
+    tree = etree.fromstring(html_content, parser)
+    if tree is None:
+        logger.error(f"网页内容解析失败: {url}")
+        return False
+    
     # 提取所有配置的字段
     extracted_fields = {}
     for field_name, field_config in config['fields'].items():
@@ -252,12 +405,7 @@ def process_url(url, config):
             continue
             
         # 提取字段值
-        extracted_value = extract_field(
-            html_content, 
-            field_config['xpath'], 
-            field_config['attribute'], 
-            base_url
-        )
+        extracted_value = extract_field(tree, field_config, base_parts)
         extracted_fields[field_name] = extracted_value
     
     # 检查必要字段
@@ -284,25 +432,54 @@ def process_url(url, config):
     
     # 处理内容中的图片
     content_html = extracted_fields['content']
-    content_with_local_images = download_content_images(content_html, image_save_dir, base_url)
-    
-    # 转换为Markdown
-    content_md = md(content_with_local_images)
+    content_with_local_images = await download_content_images(session, content_html, image_save_dir, base_parts)
     
     # 准备front-matter（不包含url字段，包含slug字段）
     front_matter = {k: v for k, v in extracted_fields.items() if k != 'content' and k != 'url'}
     
-    # 创建Markdown文件
-    success = create_markdown_file(md_save_path, front_matter, content_md)
+    # 转换为Markdown并创建文件（CPU密集型，交给进程池避免阻塞事件循环）
+    if markdown_executor is not None:
+        success = await asyncio.get_running_loop().run_in_executor(
+            markdown_executor, save_markdown, md_save_path, front_matter, content_with_local_images)
+    else:
+        success = save_markdown(md_save_path, front_matter, content_with_local_images)
     
     if success:
-        mark_as_downloaded(config['project_root'], url)
         logger.info(f"URL处理成功: {url}，保存路径: {md_save_path}")
         return True
     else:
         logger.error(f"URL处理失败: {url}")
         return False
 
+async def crawl(urls, config):
+    """并发采集URL列表，处理成功的URL写入downloaded.log"""
+    # 可通过配置项 max_workers 调整同时处理的URL数量（设为1即串行处理）
+    # 每个主机的连接数同样不超过 max_workers，页面内的图片下载也受此限制
+    max_workers = config.get('max_workers', 16)
+    semaphore = asyncio.Semaphore(max_workers)
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=min(8, max_workers))
+    # 与原先requests的timeout=10一致：限制连接和单次读取时间，不限制整个下载的总时长
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=10)
+    
+    async def run(session, url, markdown_executor):
+        async with semaphore:
+            try:
+                return url, await process_url(session, url, config, markdown_executor)
+            except Exception as e:
+                logger.error(f"处理URL时出错 {url}: {str(e)}", exc_info=True)
+                return url, False
+    
+    # 网络请求在事件循环中并发执行，Markdown转换在进程池中执行
+    # downloaded.log 只打开一次，并在处理完成时立即写入
+    downloaded_log_path = os.path.join(config['project_root'], 'downloaded.log')
+    with open(downloaded_log_path, 'a', encoding='utf-8') as downloaded_log, \
+            ProcessPoolExecutor() as markdown_executor:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            for finished in asyncio.as_completed([run(session, url, markdown_executor) for url in urls]):
+                url, success = await finished
+                if success:
+                    mark_as_downloaded(downloaded_log, url)
+
 def main(config_path):
     """主函数"""
     try:
@@ -323,18 +500,17 @@ def main(config_path):
         # 获取已下载的URL
         downloaded_urls = get_downloaded_urls(config['project_root'])
         
-        # 处理未下载的URL
-        for url in urls:
+        # 筛选未下载的URL（去除重复项，避免并发处理同一URL）
+        pending_urls = []
+        for url in dict.fromkeys(urls):
             if url in downloaded_urls:
                 logger.info(f"URL已下载，跳过: {url}")
                 continue
-            
-            # 处理URL
-            process_url(url, config)
-            
-            # 可以添加延迟，避免请求过于频繁
-            # time.sleep(1)
-            
+            pending_urls.append(url)
+        
+        # 并发处理未下载的URL
+        asyncio.run(crawl(pending_urls, config))
+        
         logger.info("所有URL处理完毕")
         
     except Exception as e:
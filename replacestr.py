@@ -1,5 +1,17 @@
 import os
+import mmap
 import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+def file_contains(file_path, needle):
+    """使用mmap在字节层面检查文件是否包含指定内容，无需解码整个文件"""
+    with open(file_path, 'rb') as file:
+        # 空文件无法进行mmap映射
+        if os.fstat(file.fileno()).st_size == 0:
+            return not needle
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm.find(needle) != -1
 
 def replace_in_file(file_path, source_str, target_str):
     """替换单个文件中的字符串"""
@@ -24,35 +36,67 @@ def replace_in_file(file_path, source_str, target_str):
         print(f"处理文件 {file_path} 时出错: {str(e)}")
         return False
 
+def process_one(file_path, source_str, target_str, needle, dry_run=False):
+    """处理单个.md文件，返回 (文件路径, 是否包含源字符串, 是否已替换)；needle为源字符串的UTF-8编码"""
+    try:
+        # 先用mmap快速预检，不包含源字符串的文件直接跳过
+        if not file_contains(file_path, needle):
+            return file_path, False, False
+        
+        # 非干运行时直接替换，文件只读取一次；无法按UTF-8解码的文件不计入结果
+        if not dry_run:
+            replaced = replace_in_file(file_path, source_str, target_str)
+            return file_path, replaced, replaced
+        
+        # 干运行时同样按UTF-8解码确认，与实际替换的结果保持一致
+        with open(file_path, 'r', encoding='utf-8') as file:
+            content = file.read()
+        return file_path, source_str in content, False
+    except Exception as e:
+        print(f"检查文件 {file_path} 时出错: {str(e)}")
+        return file_path, False, False
+
 def find_and_replace(root_dir, source_str, target_str, dry_run=False):
-    """递归查找并替换所有.md文件中的字符串"""
-    count = 0
-    modified_files = []
+    """递归查找并替换所有.md文件中的字符串（查找与替换在同一次遍历中完成）"""
+    # 先收集所有.md文件（基于os.scandir的栈式遍历，直接使用目录项缓存的类型信息）
+    file_paths = []
+    real_paths = set()
+    dir_stack = [root_dir]
+    while dir_stack:
+        try:
+            entries = os.scandir(dir_stack.pop())
+        except OSError as e:
+            print(f"读取目录时出错: {str(e)}")
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dir_stack.append(entry.path)
+                # 只处理.md文件
+                elif entry.name.lower().endswith('.md') and entry.is_file():
+                    # 符号链接与其目标文件只处理一次，避免并行写入时互相覆盖
+                    real_path = os.path.realpath(entry.path)
+                    if real_path not in real_paths:
+                        real_paths.add(real_path)
+                        file_paths.append(entry.path)
     
-    # 遍历目录
-    for dirpath, _, filenames in os.walk(root_dir):
-        for filename in filenames:
-            # 只处理.md文件
-            if filename.lower().endswith('.md'):
-                file_path = os.path.join(dirpath, filename)
-                
-                # 检查文件中是否包含源字符串
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as file:
-                        content = file.read()
-                    
-                    if source_str in content:
-                        modified_files.append(file_path)
-                        if not dry_run:
-                            if replace_in_file(file_path, source_str, target_str):
-                                count += 1
-                except Exception as e:
-                    print(f"检查文件 {file_path} 时出错: {str(e)}")
+    # 使用多进程并行处理各个文件，源字符串只编码一次
+    needle = source_str.encode('utf-8')
+    worker = functools.partial(process_one, source_str=source_str, target_str=target_str,
+                               needle=needle, dry_run=dry_run)
+    with ProcessPoolExecutor() as executor:
+        results = list(executor.map(worker, file_paths, chunksize=64))
     
-    if dry_run:
-        return modified_files, 0
+    modified_files = [file_path for file_path, matched, _ in results if matched]
+    count = sum(1 for _, _, replaced in results if replaced)
     return modified_files, count
 
+def print_file_list(title, file_paths):
+    """打印文件列表"""
+    print(f"\n{title}")
+    for file_path in file_paths:
+        print(f"  - {file_path}")
+
 def main():
     # 解析命令行参数
     parser = argparse.ArgumentParser(description='替换Markdown文件中的字符串')
@@ -68,32 +112,36 @@ def main():
         print(f"错误: 目录 '{args.root}' 不存在")
         return
     
-    # 先执行一次干运行，查看哪些文件会被修改
     print(f"正在搜索目录 '{args.root}' 下所有包含 '{args.source}' 的.md文件...")
-    modified_files, _ = find_and_replace(args.root, args.source, args.target, dry_run=True)
     
-    if not modified_files:
-        print("没有找到需要修改的文件")
-        return
-    
-    # 显示将要修改的文件
-    print(f"\n找到 {len(modified_files)} 个包含 '{args.source}' 的文件:")
-    for file_path in modified_files:
-        print(f"  - {file_path}")
-    
-    # 确认是否执行替换
+    # 需要确认时，先执行一次干运行，查看哪些文件会被修改
     if not args.force:
+        modified_files, _ = find_and_replace(args.root, args.source, args.target, dry_run=True)
+        
+        if not modified_files:
+            print("没有找到需要修改的文件")
+            return
+        
+        # 显示将要修改的文件
+        print_file_list(f"找到 {len(modified_files)} 个包含 '{args.source}' 的文件:", modified_files)
+        
+        # 确认是否执行替换
         confirm = input(f"\n确定要将所有文件中的 '{args.source}' 替换为 '{args.target}' 吗? (y/n) ")
         if confirm.lower() not in ['y', 'yes']:
             print("操作已取消")
             return
     
-    # 执行替换
+    # 执行替换（--force 模式下跳过干运行，一次遍历完成查找和替换）
     print("\n正在执行替换...")
-    _, count = find_and_replace(args.root, args.source, args.target)
+    modified_files, count = find_and_replace(args.root, args.source, args.target)
+    
+    if args.force:
+        if not modified_files:
+            print("没有找到需要修改的文件")
+            return
+        print_file_list(f"找到 {len(modified_files)} 个包含 '{args.source}' 的文件:", modified_files)
     
     print(f"\n替换完成，共修改了 {count} 个文件")
 
 if __name__ == "__main__":
     main()
-    
\ No newline at end of file